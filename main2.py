@@ -1,14 +1,19 @@
 import os
 import time
 import json
+import signal
+import functools
 import logging
+from dataclasses import dataclass
 from urllib.parse import urlparse
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional
+from typing import Dict, Any, FrozenSet, Optional
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
 from webdriver_manager.chrome import ChromeDriverManager
 
 # =====================================================
@@ -41,6 +46,59 @@ def on(k: str) -> bool:
     """
     return env(k, "0") == "1"
 
+@dataclass(frozen=True)
+class Config:
+    """
+    Typed snapshot of the environment, read once at startup and passed down
+    instead of calling env()/on() at every use site.
+    """
+    target_url: Optional[str]
+    cookie_file: Optional[str]
+    login_token: Optional[str]
+    persist_profile: bool
+    profile_dir: Optional[str]
+    user_agent: str
+    window_width: int
+    window_height: int
+    language: str
+    timezone: Optional[str]
+    block_resources: bool
+    fp_detect: bool
+    fp_webgl: bool
+    fp_canvas: bool
+    fp_audio: bool
+    webgl_vendor: str
+    webgl_renderer: str
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        """
+        Builds a Config from the current environment, applying defaults and
+        type coercion.
+
+        Returns:
+            The populated Config instance.
+        """
+        return cls(
+            target_url=env("TARGET_URL"),
+            cookie_file=env("COOKIE_FILE"),
+            login_token=env("LOGIN_TOKEN"),
+            persist_profile=on("PERSIST_PROFILE"),
+            profile_dir=env("PROFILE_DIR"),
+            user_agent=env("USER_AGENT", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"),
+            window_width=int(env("WINDOW_WIDTH") or "1920"),
+            window_height=int(env("WINDOW_HEIGHT") or "1080"),
+            language=env("LANG", "en-US,en;q=0.9"),
+            timezone=env("TIMEZONE"),
+            block_resources=on("BLOCK_RESOURCES"),
+            fp_detect=on("FP_DETECT"),
+            fp_webgl=on("FP_WEBGL"),
+            fp_canvas=on("FP_CANVAS"),
+            fp_audio=on("FP_AUDIO"),
+            webgl_vendor=env("WEBGL_VENDOR", "NVIDIA"),
+            webgl_renderer=env("WEBGL_RENDERER", "NVIDIA GeForce RTX 3080"),
+        )
+
 logging.basicConfig(
     level=logging.INFO,
     format="[%(levelname)s] %(message)s"
@@ -49,22 +107,34 @@ logging.basicConfig(
 # =====================================================
 # Cookie Handling (RFC-compliant)
 # =====================================================
-def _domain_match(cookie_domain: Optional[str], host: str) -> bool:
+def _host_suffixes(host: str) -> FrozenSet[str]:
+    """
+    Computes every domain a cookie may be scoped to for the given host.
+
+    Args:
+        host: The target host.
+
+    Returns:
+        The lowercased host and each of its parent domains,
+        e.g. {"a.example.com", "example.com", "com"}.
+    """
+    host = host.lower()
+    return frozenset(host[i:] for i in range(len(host)) if i == 0 or host[i - 1] == ".")
+
+def _domain_match(cookie_domain: Optional[str], host_suffixes: FrozenSet[str]) -> bool:
     """
     Checks if a cookie's domain matches the target host.
 
     Args:
         cookie_domain: The domain specified in the cookie.
-        host: The target host to match against.
+        host_suffixes: The target host's suffixes, as returned by _host_suffixes.
 
     Returns:
         True if the domain matches, False otherwise.
     """
     if not cookie_domain:
         return False
-    cookie_domain = cookie_domain.lstrip(".").lower()
-    host = host.lower()
-    return host == cookie_domain or host.endswith("." + cookie_domain)
+    return cookie_domain.lstrip(".").lower() in host_suffixes
 
 def _path_match(cookie_path: Optional[str], request_path: str) -> bool:
     """
@@ -81,6 +151,23 @@ def _path_match(cookie_path: Optional[str], request_path: str) -> bool:
         return True
     return request_path.startswith(cookie_path if cookie_path.startswith("/") else "/" + cookie_path)
 
+_CDP_COOKIE_KEYS = ("name", "value", "domain", "path", "secure", "httpOnly")
+
+def _to_cdp_cookie(cookie: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts a Selenium-style cookie into a CDP Network.CookieParam.
+
+    Args:
+        cookie: The cookie as accepted by driver.add_cookie.
+
+    Returns:
+        The cookie with unsupported keys dropped and 'expiry' renamed to 'expires'.
+    """
+    cdp_cookie = {k: cookie[k] for k in _CDP_COOKIE_KEYS if k in cookie}
+    if "expiry" in cookie:
+        cdp_cookie["expires"] = cookie["expiry"]
+    return cdp_cookie
+
 def load_cookies_domain_safe(driver: webdriver.Chrome, cookie_file: str, target_url: str) -> None:
     """
     Loads cookies from a JSON file into the browser, ensuring domain and path
@@ -98,47 +185,110 @@ def load_cookies_domain_safe(driver: webdriver.Chrome, cookie_file: str, target_
     parsed_url = urlparse(target_url)
     base_url = f"{parsed_url.scheme}://{parsed_url.hostname}/"
     request_path = parsed_url.path or "/"
-
-    driver.get(base_url) # Navigate to base to ensure cookies are set for the domain
+    host_suffixes = _host_suffixes(parsed_url.hostname)
 
     with open(cookie_file, "r", encoding="utf-8") as f:
         cookies = json.load(f)
 
-    added_count = 0
-    skipped_count = 0
-
-    for cookie_data in cookies:
-        cookie = dict(cookie_data) # Ensure we're working with a mutable dictionary
-        cookie.pop("sameSite", None) # Remove SameSite attribute for broader compatibility
-
-        if not _domain_match(cookie.get("domain"), parsed_url.hostname):
-            skipped_count += 1
-            continue
-        if not _path_match(cookie.get("path", "/"), request_path):
-            skipped_count += 1
-            continue
-        if cookie.get("secure") and parsed_url.scheme != "https":
-            skipped_count += 1
-            continue
+    # Filter on the parsed entries directly; cookies are only copied once converted
+    is_https = parsed_url.scheme == "https"
+    survivors = [
+        c for c in cookies
+        if _domain_match(c.get("domain"), host_suffixes)
+        and _path_match(c.get("path", "/"), request_path)
+        and not (c.get("secure") and not is_https)
+    ]
 
+    added_count = 0
+    skipped_count = len(cookies) - len(survivors)
+    # Network.setCookies succeeds even when Chrome drops an individual cookie
+    # (e.g. a __Host- prefix violation), so batched cookies are only "sent".
+    count_label = "applied"
+
+    if survivors:
+        # One CDP round-trip for the whole jar instead of one add_cookie per cookie.
+        # Network.setCookies rejects the batch as a whole, so any failure falls
+        # back to per-cookie add_cookie to keep the valid ones.
         try:
-            driver.add_cookie(cookie)
-            added_count += 1
+            driver.execute_cdp_cmd(
+                "Network.setCookies",
+                {"cookies": [_to_cdp_cookie(c) for c in survivors]}
+            )
+            added_count = len(survivors)
+            count_label = "sent"
         except Exception as e:
-            logging.warning(f"Failed to add cookie: {cookie}. Error: {e}")
-            skipped_count += 1
+            logging.warning(f"Batch cookie load failed, falling back to add_cookie. Error: {e}")
+            driver.get(base_url) # Navigate to base to ensure cookies are set for the domain
+            for c in survivors:
+                # Remove SameSite attribute for broader compatibility
+                cookie = {k: v for k, v in c.items() if k != "sameSite"}
+                try:
+                    driver.add_cookie(cookie)
+                    added_count += 1
+                except Exception as e:
+                    logging.warning(f"Failed to add cookie: {cookie}. Error: {e}")
+                    skipped_count += 1
 
     driver.get(target_url)
     driver.refresh()
-    logging.info(f"Cookies applied: {added_count}, skipped: {skipped_count}")
+    logging.info(f"Cookies {count_label}: {added_count}, skipped: {skipped_count}")
 
 # =====================================================
 # Browser Bootstrap (Selenium Stealth & Configuration)
 # =====================================================
-def start_browser() -> webdriver.Chrome:
+# Font/media URL patterns dropped when BLOCK_RESOURCES=1. Network.setBlockedURLs
+# treats '*' as "anything", so a URL is blocked if it *contains* the extension
+# anywhere (host, path or query), not only at the end of the path; only
+# extensions unlikely to appear elsewhere are listed. Blocking by resource type
+# would need Fetch.enable, which pauses every matched request until the client
+# answers an event that plain Selenium cannot receive. Images are disabled by
+# content setting instead, which also covers extensionless URLs.
+BLOCKED_URL_PATTERNS = (
+    "*.woff2", "*.ttf", "*.otf",
+    "*.mp4", "*.webm", "*.mp3",
+)
+
+# File remembering the ChromeDriver path resolved by webdriver_manager, so later
+# runs can start without its version probe.
+DRIVER_PATH_FILE = ".chromedriver_path"
+
+def _cached_driver_path() -> Optional[str]:
+    """
+    Reads the ChromeDriver path saved by a previous run.
+
+    Returns:
+        The saved path if it still points to an executable, None otherwise.
+    """
+    try:
+        with open(DRIVER_PATH_FILE, "r", encoding="utf-8") as f:
+            path = f.read().strip()
+    except OSError:
+        return None
+    return path if path and os.access(path, os.X_OK) else None
+
+def _install_driver_path() -> str:
+    """
+    Resolves the ChromeDriver path through webdriver_manager and saves it for
+    later runs.
+
+    Returns:
+        The filesystem path to the ChromeDriver executable.
+    """
+    path = ChromeDriverManager().install()
+    try:
+        with open(DRIVER_PATH_FILE, "w", encoding="utf-8") as f:
+            f.write(path)
+    except OSError as e:
+        logging.warning(f"Could not save ChromeDriver path: {e}")
+    return path
+
+def start_browser(cfg: Config) -> webdriver.Chrome:
     """
     Initializes and configures the Selenium Chrome browser instance.
 
+    Args:
+        cfg: The runtime configuration.
+
     Returns:
         A configured Selenium Chrome WebDriver instance.
 
@@ -153,153 +303,241 @@ def start_browser() -> webdriver.Chrome:
     opts.add_argument("--disable-blink-features=AutomationControlled")
 
     # Persistent profile option
-    if on("PERSIST_PROFILE"):
-        profile_dir = env('PROFILE_DIR')
-        if profile_dir:
-            opts.add_argument(f"--user-data-dir={profile_dir}")
+    if cfg.persist_profile:
+        if cfg.profile_dir:
+            opts.add_argument(f"--user-data-dir={cfg.profile_dir}")
         else:
             logging.warning("PERSIST_PROFILE is enabled but PROFILE_DIR is not set.")
 
     # User agent and window size
-    user_agent = env('USER_AGENT', "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-    window_width = env('WINDOW_WIDTH', '1920')
-    window_height = env('WINDOW_HEIGHT', '1080')
-    language = env('LANG', 'en-US,en;q=0.9')
-
-    opts.add_argument(f"user-agent={user_agent}")
-    opts.add_argument(f"--window-size={window_width},{window_height}")
-    opts.add_argument(f"--lang={language}")
-
-    # Initialize WebDriver
+    opts.add_argument(f"user-agent={cfg.user_agent}")
+    opts.add_argument(f"--window-size={cfg.window_width},{cfg.window_height}")
+    opts.add_argument(f"--lang={cfg.language}")
+
+    # Resource blocking: images by content setting (see BLOCKED_URL_PATTERNS
+    # for fonts/media)
+    if cfg.block_resources:
+        opts.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+
+    # Initialize WebDriver, reusing the saved driver path when there is one.
+    # A saved driver can go stale after a Chrome update, so a failed start with
+    # it is retried once with a freshly resolved driver.
+    cached_path = _cached_driver_path()
     try:
         driver = webdriver.Chrome(
-            service=Service(ChromeDriverManager().install()),
+            service=Service(cached_path or _install_driver_path()),
             options=opts
         )
     except Exception as e:
-        logging.error(f"Failed to initialize Chrome WebDriver: {e}")
-        raise
+        if not cached_path:
+            logging.error(f"Failed to initialize Chrome WebDriver: {e}")
+            raise
+        logging.warning(f"Saved ChromeDriver failed to start, resolving it again: {e}")
+        try:
+            driver = webdriver.Chrome(
+                service=Service(_install_driver_path()),
+                options=opts
+            )
+        except Exception as e:
+            logging.error(f"Failed to initialize Chrome WebDriver: {e}")
+            raise
 
     # Timezone override
-    if env("TIMEZONE"):
+    if cfg.timezone:
         try:
             driver.execute_cdp_cmd(
                 "Emulation.setTimezoneOverride",
-                {"timezoneId": env("TIMEZONE")}
+                {"timezoneId": cfg.timezone}
             )
         except Exception as e:
             logging.warning(f"Could not set timezone override: {e}")
 
+    # Resource blocking (fonts, media)
+    if cfg.block_resources:
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(BLOCKED_URL_PATTERNS)})
+        except Exception as e:
+            logging.warning(f"Could not enable resource blocking: {e}")
+
+    # Fingerprint detection hooks, installed ahead of the first navigation
+    inject_fp_detection(driver, cfg)
+
     return driver
 
 # =====================================================
 # Fingerprint Observation & Overrides (Passive)
 # =====================================================
-def inject_fp_detection(driver: webdriver.Chrome) -> None:
+# Scripts are built once at import and reused for every injection.
+FP_DETECT_JS = """
+(() => {
+  if (window.__fp_used) return;
+  const used = new Uint8Array(3);
+  const wrap = (ctor, method, bit) => {
+    const proto = ctor && ctor.prototype;
+    const orig = proto && proto[method];
+    if (typeof orig !== "function") return;
+    proto[method] = new Proxy(orig, {
+      apply(target, self, args) {
+        used[bit] = 1;
+        return Reflect.apply(target, self, args);
+      }
+    });
+  };
+
+  wrap(window.WebGLRenderingContext, "getParameter", 0);
+  wrap(window.HTMLCanvasElement, "toDataURL", 1);
+  wrap(window.AudioBuffer, "getChannelData", 2);
+
+  window.__fp_used = {
+    get webgl() { return !!used[0]; },
+    get canvas() { return !!used[1]; },
+    get audio() { return !!used[2]; }
+  };
+})();
+"""
+
+FP_CANVAS_JS = """
+const t = HTMLCanvasElement.prototype.toDataURL;
+HTMLCanvasElement.prototype.toDataURL = function(){
+  const c=this.getContext('2d'); c.globalAlpha=0.999999;
+  return t.apply(this,arguments);
+};
+"""
+
+FP_AUDIO_JS = """
+const o = AudioBuffer.prototype.getChannelData;
+AudioBuffer.prototype.getChannelData = function(){
+  const d=o.apply(this,arguments);
+  for(let i=0;i<d.length;i+=100)d[i]+=1e-7;
+  return d;
+};
+"""
+
+@functools.lru_cache(maxsize=None)
+def _webgl_override_js(vendor: str, renderer: str) -> str:
+    """
+    Builds the WebGL vendor/renderer override script, cached per value pair.
+
+    Args:
+        vendor: The value reported for UNMASKED_VENDOR_WEBGL.
+        renderer: The value reported for UNMASKED_RENDERER_WEBGL.
+
+    Returns:
+        The JavaScript source of the override.
+    """
+    return f"""
+const g = WebGLRenderingContext.prototype.getParameter;
+WebGLRenderingContext.prototype.getParameter = function(p){{
+  if(p===37445) return "{vendor}";
+  if(p===37446) return "{renderer}";
+  return g.call(this,p);
+}};
+"""
+
+def inject_fp_detection(driver: webdriver.Chrome, cfg: Config) -> None:
     """
-    Injects JavaScript to detect fingerprinting techniques.
+    Registers JavaScript to detect fingerprinting techniques on every new
+    document, before any page script runs.
 
     Args:
         driver: The Selenium WebDriver instance.
+        cfg: The runtime configuration.
     """
-    if not on("FP_DETECT"):
+    if not cfg.fp_detect:
         return
 
-    driver.execute_script("""
-    (() => {
-      if (window.__fp_used) return;
-      window.__fp_used = {webgl:false, canvas:false, audio:false};
-
-      try {
-        const g = WebGLRenderingContext.prototype.getParameter;
-        WebGLRenderingContext.prototype.getParameter = function(){
-          window.__fp_used.webgl = true;
-          return g.apply(this, arguments);
-        };
-      } catch(e){}
-
-      try {
-        const t = HTMLCanvasElement.prototype.toDataURL;
-        HTMLCanvasElement.prototype.toDataURL = function(){
-          window.__fp_used.canvas = true;
-          return t.apply(this, arguments);
-        };
-      } catch(e){}
-
-      try {
-        const a = AudioContext.prototype.getChannelData;
-        AudioContext.prototype.getChannelData = function(){
-          window.__fp_used.audio = true;
-          return a.apply(this, arguments);
-        };
-      } catch(e){}
-    })();
-    """)
-
-def apply_fp_overrides(driver: webdriver.Chrome, used: Dict[str, bool]) -> None:
+    try:
+        driver.execute_cdp_cmd(
+            "Page.addScriptToEvaluateOnNewDocument",
+            {"source": FP_DETECT_JS}
+        )
+    except Exception as e:
+        logging.warning(f"Could not register fingerprint detection script: {e}")
+
+def apply_fp_overrides(driver: webdriver.Chrome, used: Dict[str, bool], cfg: Config) -> None:
     """
     Applies JavaScript overrides to mask fingerprinting data.
 
     Args:
         driver: The Selenium WebDriver instance.
         used: A dictionary indicating which fingerprinting surfaces were detected as used.
+        cfg: The runtime configuration.
     """
-    if used.get("webgl") and on("FP_WEBGL"):
-        driver.execute_script(f"""
-        const g = WebGLRenderingContext.prototype.getParameter;
-        WebGLRenderingContext.prototype.getParameter = function(p){{
-          if(p===37445) return "{env('WEBGL_VENDOR', 'NVIDIA')}";
-          if(p===37446) return "{env('WEBGL_RENDERER', 'NVIDIA GeForce RTX 3080')}";
-          return g.call(this,p);
-        }};
-        """)
+    if used.get("webgl") and cfg.fp_webgl:
+        driver.execute_script(_webgl_override_js(cfg.webgl_vendor, cfg.webgl_renderer))
 
-    if used.get("canvas") and on("FP_CANVAS"):
-        driver.execute_script("""
-        const t = HTMLCanvasElement.prototype.toDataURL;
-        HTMLCanvasElement.prototype.toDataURL = function(){
-          const c=this.getContext('2d'); c.globalAlpha=0.999999;
-          return t.apply(this,arguments);
-        };
-        """)
+    if used.get("canvas") and cfg.fp_canvas:
+        driver.execute_script(FP_CANVAS_JS)
 
-    if used.get("audio") and on("FP_AUDIO"):
-        driver.execute_script("""
-        const o = AudioContext.prototype.getChannelData;
-        AudioContext.prototype.getChannelData = function(){
-          const d=o.apply(this,arguments);
-          for(let i=0;i<d.length;i+=100)d[i]+=1e-7;
-          return d;
-        };
-        """)
+    if used.get("audio") and cfg.fp_audio:
+        driver.execute_script(FP_AUDIO_JS)
 
 # =====================================================
 # Login Flow (Cookie-first, Token Optional)
 # =====================================================
+WAIT_TIMEOUT = 10
+WAIT_POLL = 0.05
+
+def _wait_for_script(driver: webdriver.Chrome, condition: str, description: str) -> None:
+    """
+    Polls a JavaScript condition until it is truthy instead of sleeping a fixed time.
+
+    Args:
+        driver: The Selenium WebDriver instance.
+        condition: A JavaScript expression evaluated in the page.
+        description: What is being waited for, used in the timeout warning.
+    """
+    try:
+        WebDriverWait(driver, WAIT_TIMEOUT, poll_frequency=WAIT_POLL).until(
+            lambda d: d.execute_script(f"return !!({condition})")
+        )
+    except TimeoutException:
+        logging.warning(f"Timed out after {WAIT_TIMEOUT}s waiting for {description}.")
+
+class _ShutdownRequested(Exception):
+    """
+    Raised by the SIGINT/SIGTERM handler to end browser_login's idle wait.
+    """
+
+def _request_shutdown(signum: int, frame: object) -> None:
+    """
+    Signal handler that interrupts the idle wait in browser_login.
+
+    Args:
+        signum: The received signal number.
+        frame: The interrupted stack frame.
+
+    Raises:
+        _ShutdownRequested: Always.
+    """
+    raise _ShutdownRequested()
+
 def browser_login() -> None:
     """
     Handles the browser initialization, cookie loading, and optional token login.
     Includes fingerprint detection and overrides.
     """
-    driver = start_browser()
-    url = env("TARGET_URL")
+    cfg = Config.from_env()
+    driver = start_browser(cfg)
+    url = cfg.target_url
     if not url:
         logging.error("TARGET_URL environment variable not set.")
         driver.quit()
         return
 
     driver.get(url)
-    time.sleep(2) # Initial page load wait
+    _wait_for_script(driver, "document.readyState === 'complete'", "initial page load")
 
     # Load cookies if a cookie file is specified
-    cookie_file = env("COOKIE_FILE")
+    cookie_file = cfg.cookie_file
     if cookie_file:
         load_cookies_domain_safe(driver, cookie_file, url)
     else:
         logging.info("COOKIE_FILE not set, skipping cookie loading.")
 
     # Apply login token if provided
-    login_token = env("LOGIN_TOKEN")
+    login_token = cfg.login_token
     if login_token:
         driver.execute_script(f"""
         (() => {{
@@ -311,24 +549,32 @@ def browser_login() -> None:
         """)
         time.sleep(3) # Allow time for token to be applied and page to reload
 
-    # Fingerprint detection and overrides
-    inject_fp_detection(driver)
-    time.sleep(2) # Give JS time to inject and run
-
+    # Fingerprint overrides (detection hooks were registered in start_browser)
     used = driver.execute_script("return window.__fp_used || {}")
     logging.info(f"Fingerprint surfaces detected as used: {used}")
 
-    apply_fp_overrides(driver, used)
+    apply_fp_overrides(driver, used, cfg)
 
     logging.info("Session stabilized and browser ready.")
 
-    # Keep the browser open
-    while True:
-        time.sleep(60)
+    # Keep the browser open until SIGINT/SIGTERM. The handler raises, which ends
+    # signal.pause() (POSIX, no wakeups) or time.sleep() (Windows has no pause())
+    # immediately instead of letting them resume after the handler returns.
+    signal.signal(signal.SIGINT, _request_shutdown)
+    signal.signal(signal.SIGTERM, _request_shutdown)
+    try:
+        while True:
+            if hasattr(signal, "pause"):
+                signal.pause()
+            else:
+                time.sleep(3600)
+    except _ShutdownRequested:
+        logging.info("Shutdown signal received, closing browser.")
+    finally:
+        driver.quit()
 
 # =====================================================
 # Entry Point
 # =====================================================
 if __name__ == "__main__":
     browser_login()
-```